@@ -0,0 +1,37 @@
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def fused_kde(x, values, colors, bw, cbw):
+    """
+    Gaussian kernel sums and kernel-weighted average colors in one pass.
+
+    Equivalent to ``w.sum(axis=1)`` and ``(wc @ colors) / wc.sum(axis=1)``,
+    with ``w`` and ``wc`` the kernel matrices for bandwidths `bw` and
+    `cbw`, without allocating the (points, n) matrices. `colors` may
+    have zero columns if only the density is needed.
+    """
+    inv_bw2 = 1 / bw**2
+    inv_cbw2 = 1 / cbw**2
+    same = cbw == bw
+    k = colors.shape[1]
+    wsum = np.empty(len(x))
+    cavg = np.empty((len(x), k))
+    for i in numba.prange(len(x)):
+        sw = 0.0
+        swc = 0.0
+        acc = np.zeros(k)
+        for j in range(len(values)):
+            d2 = (x[i] - values[j])**2
+            w = np.exp(-d2 * inv_bw2)
+            sw += w
+            if k:
+                wc = w if same else np.exp(-d2 * inv_cbw2)
+                swc += wc
+                for l in range(k):
+                    acc[l] += wc * colors[j, l]
+        wsum[i] = sw
+        for l in range(k):
+            cavg[i, l] = acc[l] / swc
+    return wsum, cavg
@@ -1,5 +1,15 @@
+import functools
+
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+
+__all__ = ['cello', 'determine_kde_bw']
+
+# Number of kernel weights evaluated at once when evaluating full kernel
+# matrices; about 2 MB in double precision, which fits in L2 cache
+KDE_CHUNK_SIZE = 262144
 
 
 def determine_kde_bw(values, hint=None, rule='scott'):
@@ -31,6 +41,14 @@ def determine_kde_bw(values, hint=None, rule='scott'):
     ValueError
         If hint is an array with incorrect length or an unrecognized value.
     """
+    # A fixed bandwidth needs no statistics, nor an array of the values
+    if isinstance(hint, (int, float)):
+        ndim = getattr(values, 'ndim', None)
+        if ndim is None and isinstance(values, (list, tuple)):
+            ndim = 1 + (len(values) > 0 and np.ndim(values[0]) > 0)
+        if ndim is not None:
+            return len(values)*(hint, ) if ndim > 1 else hint
+
     values = np.asarray(values)
     
     ## Handle multiple series
@@ -41,8 +59,16 @@ def determine_kde_bw(values, hint=None, rule='scott'):
             # Global bandwidth: compute from all data
             return n*(determine_kde_bw(values.flatten(), None, rule), )
         elif hint == 'local':
-            # Local bandwidth: compute per series (None or 'local')
-            return tuple(determine_kde_bw(series, None, rule) for series in values)
+            # Local bandwidth: compute for all series at once
+            std = values.std(axis=1)
+            size = values.shape[1]
+            if rule == 'scott':
+                return tuple(std * size**(-1/5))
+            elif rule == 'silverman':
+                q25, q75 = np.percentile(values, [25, 75], axis=1)
+                iqr = (q75 - q25) / 1.349
+                return tuple((size * 3/4)**(-1/5) * np.minimum(std, iqr))
+            raise ValueError(f"Unknown rule: {rule}. Use 'scott' or 'silverman'.")
         elif isinstance(hint, (float, int)):
             # Fixed bandwidth for all series
             return n*(hint, )
@@ -58,17 +84,302 @@ def determine_kde_bw(values, hint=None, rule='scott'):
 
     if isinstance(hint, (int, float)):
         return hint
-    
+
     if rule == 'scott':
         return values.std() * values.size**(-1/5)
     elif rule == 'silverman':
         std = values.std()
-        iqr = (np.percentile(values, 75) - np.percentile(values, 25)) / 1.349
+        q25, q75 = np.percentile(values, [25, 75])
+        iqr = (q75 - q25) / 1.349
         return (values.size * 3/4)**(-1/5) * min(std, iqr)
     raise ValueError(f"Unknown rule: {rule}. Use 'scott' or 'silverman'.")
         
 
 
+def _binned_kde(x, values, bw, weights=None):
+    """
+    Gaussian kernel sums on a uniform grid through binning and convolution.
+
+    Approximates ``np.exp(-(x[:, None] - values[None, :])**2 / bw**2).sum(axis=1)``
+    (or ``... @ weights`` when weights are given) by linear binning, which
+    splits each value over its two neighbouring grid points, and convolving
+    the binned counts with a Gaussian kernel truncated at 4 bandwidths. This
+    takes O(n + points*k) operations instead of O(n*points).
+    """
+    n = len(x)
+    dx = x[1] - x[0]
+    pos = (values - x[0]) / dx
+    idx = np.clip(np.floor(pos).astype(int), 0, n - 2)
+    frac = pos - idx
+    k = int(np.ceil(4 * bw / dx))
+    kernel = np.exp(-(np.arange(-k, k + 1) * dx / bw)**2)
+    single = weights is None
+    if single:
+        weights = np.ones((len(values), 1))
+    out = np.empty((n, weights.shape[1]))
+    for j, wj in enumerate(weights.T):
+        binned = (
+            np.bincount(idx, (1 - frac) * wj, minlength=n) +
+            np.bincount(idx + 1, frac * wj, minlength=n)
+        )
+        out[:, j] = np.convolve(binned, kernel)[k:k + n]
+    return out[:, 0] if single else out
+
+
+@functools.lru_cache(maxsize=None)
+def _load_fused_kde():
+    """
+    Import the numba kernel on first use, as importing numba is slow.
+
+    Returns None if numba is not installed.
+    """
+    try:
+        from ._fused import fused_kde
+    except ImportError:
+        return None
+    return fused_kde
+
+
+def _kde_method(points, n, use_numba=False):
+    """
+    Choose how to evaluate the kernel sums for n values on a grid.
+
+    Many values on a uniform grid are binned ('binned'), and many values on
+    an explicit grid are evaluated in windows ('windowed'). Otherwise the
+    numba kernel is used if requested and available ('fused'), or the full
+    kernel matrix is evaluated ('dense').
+    """
+    if isinstance(points, int) and points > 1 and n > 4*points:
+        return 'binned'
+    if not isinstance(points, int) and n > 4*len(points):
+        return 'windowed'
+    if use_numba and _load_fused_kde() is not None:
+        return 'fused'
+    return 'dense'
+
+
+def _dense_kde(x, values, bw, cbw, colors=None, dtype=float):
+    """
+    Gaussian kernel sums and kernel-weighted average colors.
+
+    Evaluates the full kernel matrices, in the floating point type `dtype`,
+    in blocks of about KDE_CHUNK_SIZE weights.
+    Leading dimensions of `x` (..., points), `values` (..., n), `bw` and
+    `cbw` (...) and `colors` (..., n, k) are broadcast, so several series
+    can be processed in one go.
+    """
+    # Evaluate blocks of grid points that keep the matrices in cache
+    chunk = max(1, KDE_CHUNK_SIZE // values.size)
+    if x.shape[-1] > chunk:
+        parts = [
+            _dense_kde(x[..., i:i + chunk], values, bw, cbw, colors, dtype)
+            for i in range(0, x.shape[-1], chunk)
+        ]
+        wsum = np.concatenate([part[0] for part in parts], axis=-1)
+        if colors is None:
+            return wsum, None
+        return wsum, np.concatenate([part[1] for part in parts], axis=-2)
+
+    bw = np.asarray(bw, dtype=dtype)[..., None, None]
+    cbw = np.asarray(cbw, dtype=dtype)[..., None, None]
+    d2 = np.subtract(x[..., :, None], values[..., None, :], dtype=dtype)
+    np.square(d2, out=d2)
+    # The squared distances are only needed again for a separate color
+    # bandwidth, as exp(-d2/bw**2)**((bw/cbw)**2) == exp(-d2/cbw**2).
+    # Otherwise, the weights overwrite them.
+    separate = colors is not None and not np.array_equal(cbw, bw)
+    w = np.divide(d2, -bw**2, out=None if separate else d2)
+    np.exp(w, out=w)
+    wsum = w.sum(axis=-1)
+    if colors is None:
+        return wsum, None
+    if separate:
+        wc = np.divide(d2, -cbw**2, out=d2)
+        np.exp(wc, out=wc)
+        wcsum = wc.sum(axis=-1)
+    else:
+        wc, wcsum = w, wsum
+    cavg = wc @ colors.astype(dtype, copy=False)
+    cavg /= wcsum[..., None]
+    return wsum, cavg
+
+
+def _window_sums(x, vals, lo, counts, bw, cbw, colors=None):
+    """
+    Kernel sums over the windows of sorted values of a block of grid points.
+
+    Returns the density kernel sums and, if `colors` is given, the color
+    kernel sums and the color-weighted kernel sums.
+    """
+    # Flattened (grid point, value) pairs within the windows
+    row = np.repeat(np.arange(len(x)), counts)
+    col = np.arange(counts.sum()) + np.repeat(lo - np.cumsum(counts) + counts, counts)
+    d2 = (x[row] - vals[col])**2
+    w = np.exp(-d2 / bw**2)
+    wsum = np.bincount(row, w, minlength=len(x))
+    if colors is None:
+        return wsum, None, None
+    if cbw == bw:
+        wc, den = w, wsum.copy()
+    else:
+        wc = np.exp(-d2 / cbw**2)
+        den = np.bincount(row, wc, minlength=len(x))
+    num = np.array([np.bincount(row, wc * cj[col], minlength=len(x)) for cj in colors.T]).T
+    return wsum, den, num
+
+
+def _windowed_kde(x, values, bw, cbw, colors=None):
+    """
+    Gaussian kernel sums and kernel-weighted average colors, truncated.
+
+    Only pairs of grid points and values less than 4 bandwidths apart are
+    evaluated, finding the window of each grid point in the sorted values.
+    This takes O(n log n + pairs) operations instead of O(n*points). The
+    pairs are evaluated in blocks of about KDE_CHUNK_SIZE.
+    """
+    order = np.argsort(values)
+    vals = values[order]
+    if colors is not None:
+        colors = np.asarray(colors)[order]
+    r = 4 * (bw if colors is None else max(bw, cbw))
+    lo = np.searchsorted(vals, x - r)
+    counts = np.searchsorted(vals, x + r, side='right') - lo
+    # Windows covering most values do not save anything
+    ends = np.cumsum(counts)
+    if ends[-1] > len(x) * len(vals) / 2:
+        return _dense_kde(x, vals, bw, cbw, colors)
+
+    wsum = np.empty(len(x))
+    if colors is not None:
+        den = np.empty(len(x))
+        cavg = np.empty((len(x), colors.shape[1]))
+    start = 0
+    while start < len(x):
+        limit = ends[start] - counts[start] + KDE_CHUNK_SIZE
+        stop = max(start + 1, np.searchsorted(ends, limit, side='right'))
+        block = slice(start, stop)
+        sums = _window_sums(x[block], vals, lo[block], counts[block], bw, cbw, colors)
+        wsum[block] = sums[0]
+        if colors is not None:
+            den[block], cavg[block] = sums[1], sums[2]
+        start = stop
+    if colors is None:
+        return wsum, None
+
+    # Grid points without values in reach take the full evaluation
+    empty = den == 0
+    den[empty] = 1
+    cavg /= den[:, None]
+    if empty.any():
+        cavg[empty] = _dense_kde(x[empty], vals, bw, cbw, colors)[1]
+    return wsum, cavg
+
+
+def _kde(x, values, bw, cbw, colors=None, method='dense', dtype=float):
+    """
+    Gaussian kernel sums and kernel-weighted average colors for one series.
+
+    Returns the kernel sums at `x` and, if `colors` is given, the average
+    colors at `x` (or None), using the given evaluation method. The full
+    kernel matrices ('dense') are evaluated in the floating point type `dtype`.
+    """
+    # Binning does not resolve bandwidths of less than about two grid spacings
+    if method == 'binned':
+        if min(bw, bw if colors is None else cbw) < 2 * abs(x[1] - x[0]):
+            method = 'windowed'
+    if method == 'binned':
+        wsum = _binned_kde(x, values, bw)
+        if colors is None:
+            return wsum, None
+        cavg = _binned_kde(x, values, cbw, colors)
+        den = _binned_kde(x, values, cbw)
+        # Grid points without values in reach take the full evaluation
+        empty = den == 0
+        den[empty] = 1
+        cavg /= den[:, None]
+        if empty.any():
+            cavg[empty] = _dense_kde(x[empty], values, bw, cbw, colors)[1]
+        return wsum, cavg
+    if method == 'fused':
+        fused_kde = _load_fused_kde()
+        if colors is None:
+            wsum, _ = fused_kde(
+                x.astype(float), values.astype(float), np.empty((len(values), 0)),
+                float(bw), float(cbw)
+            )
+            return wsum, None
+        return fused_kde(
+            x.astype(float), values.astype(float), colors.astype(float),
+            float(bw), float(cbw)
+        )
+    if method == 'windowed':
+        return _windowed_kde(x, values, bw, cbw, colors)
+    return _dense_kde(x, values, bw, cbw, colors, dtype)
+
+
+def _draw_cello(ax, x, y, values, c, position, basis, horizontal, side, zorder):
+    """
+    Draw a single cello from its grid, density and colors.
+
+    Returns the colored mesh artist (None if `c` is None) and the
+    collection of outlines and base lines.
+    """
+    # Modify for ribbon
+    xx = np.array([x, x])
+    yy = (np.array([y, -y]).T * (1, side not in ('right', 'left'))).T
+    if basis is not None:
+        yy[1] = basis
+        if side == 'left':
+            pass
+        elif side == 'right':
+            yy = -yy
+        else:
+            xx = np.hstack([xx, xx[:, ::-1]])
+            yy = np.hstack([yy, -yy[:, ::-1]])
+    if position is not None:
+        yy += position
+    xx, yy = [xx, yy] if horizontal else [yy, xx] 
+    
+    # Plotting
+    
+    # - Body
+    mesh = None
+    if c is not None:
+        cc = np.array([c, c])
+        if basis is not None:
+            cc = np.hstack([cc, cc[:, ::-1]])
+        mesh = ax.pcolormesh(xx, yy, cc, shading='gouraud', zorder=zorder)
+
+    # - Outlines, drawn as one collection
+    n = len(x)
+    segments = [
+        np.c_[xx[0, :n], yy[0, :n]], np.c_[xx[1, :n], yy[1, :n]],
+        np.c_[xx[0, n:], yy[0, n:]], np.c_[xx[1, n:], yy[1, n:]],
+    ]
+    linewidths = [0.5, 0.5, 0.5, 0.5]
+                 
+    # - Base line, always marking the domain of the data
+    #   Thicker line draws data, thinner line extent of density
+    #   TODO: control line thicknesses
+    if position is not None:
+        for lo, hi, lw in [(x.min(), x.max(), 0.5), (values.min(), values.max(), 2)]:
+            xy = [[lo, hi], [position, position]]
+            segments.append(np.c_[xy[not horizontal], xy[horizontal]])
+            linewidths.append(lw)
+
+    #   Without zorder, stack like lines from ax.plot (zorder 2)
+    keep = [len(seg) > 0 for seg in segments]
+    lines = LineCollection(
+        [seg for seg, k in zip(segments, keep) if k],
+        colors='k', linewidths=[lw for lw, k in zip(linewidths, keep) if k],
+        zorder=2 if zorder is None else zorder
+    )
+    ax.add_collection(lines)
+    ax.autoscale_view()
+
+    return mesh, lines
+
+
 def cello(values, c=None, position=None, basis=None, bw=None, cbw=None, scale=10, 
           points=100, horizontal=False, side='both', ax=None, **kwargs):
     """
@@ -110,7 +421,11 @@ def cello(values, c=None, position=None, basis=None, bw=None, cbw=None, scale=10
         Axes on which to draw. If None, uses the current axes.
     **kwargs
         Additional keyword arguments passed to the underlying Matplotlib
-        plotting functions (e.g., `zorder`, `linewidth`, etc.).
+        plotting functions (e.g., `zorder`, `linewidth`, etc.). `dtype` sets
+        the floating point type of the kernel weights; by default float32
+        for float32 input and float64 otherwise. `numba=True` evaluates the
+        kernels with a parallel numba kernel, if numba is installed, where
+        the full kernel matrices would otherwise be computed with NumPy.
 
     Returns
     -------
@@ -125,6 +440,8 @@ def cello(values, c=None, position=None, basis=None, bw=None, cbw=None, scale=10
                     The axes used for drawing.
                 'mesh' : QuadMesh or None
                     The colored mesh artist, if drawn.
+                'lines' : LineCollection
+                    The outlines and base lines.
             }
         For 2-D input:
             {
@@ -160,44 +477,100 @@ def cello(values, c=None, position=None, basis=None, bw=None, cbw=None, scale=10
     else:
         cbw = determine_kde_bw(values, cbw, rule=kwargs.get('bwrule', 'scott'))
 
+    # Kernel weights are evaluated in single precision for single precision input
+    dtype = kwargs.get('dtype', None)
+    if dtype is None:
+        dtype = np.float32 if values.dtype == np.float32 else float
+
+    # Color handling
+    # a. No color (None); handled below
+    # b. Named color (str)
+    # c. Single color (3 or 4 tuple)
+    # d. Color per value (n by 3-or-4 array)
+    # Single colors (b, c) are converted to RGBA once, also for all groups
+    if c is not None:
+        if (
+                isinstance(c, str) or
+                np.ndim(c) == 0 or
+                (isinstance(c, (tuple, list)) and len(c) in (3, 4))
+        ):
+            c = np.array(to_rgba(c))
+
+    # Per-value colors that are all the same are a single color
+    uniform_color = c is not None and np.ndim(c) == 1
+    if c is not None and not uniform_color:
+        c = np.asarray(c)
+        rows = c.reshape(-1, c.shape[-1])
+        if (rows == rows[0]).all():
+            c = np.clip(rows[0], 0, 1)
+            uniform_color = True
+    colors = None if c is None or uniform_color else c
+
     ## Processing cello ensemble
     
     # Handling array cello plots
+    # The densities and colors of all groups are computed first; the
+    # groups are drawn one by one afterwards.
     zorder = kwargs.pop('zorder', None)
     if values.ndim == 2:
+        m = len(values)
+        if isinstance(points, int):
+            x = np.linspace(
+                values.min(axis=1) - 3*np.asarray(bw),
+                values.max(axis=1) + 3*np.asarray(bw),
+                points, axis=1
+            )
+        else:
+            x = np.broadcast_to(np.asarray(points), (m, len(points)))
+
+        method = _kde_method(points, values.shape[1], kwargs.get('numba', False))
+        if method == 'dense':
+            wsum, cavg = _dense_kde(x, values, bw, cbw, colors, dtype)
+        else:
+            kdes = [
+                _kde(x[idx], vals, bw[idx], cbw[idx],
+                     colors if colors is None or colors.ndim == 2 else colors[idx],
+                     method, dtype)
+                for idx, vals in enumerate(values)
+            ]
+            wsum = np.array([k[0] for k in kdes])
+            cavg = None if colors is None else np.array([k[1] for k in kdes])
+        y = np.asarray(wsum, dtype=float)
+        y *= scale / y.sum(axis=1, keepdims=True)  # normalized densities
+        if cavg is not None:
+            cavg = np.clip(cavg, 0, 1, out=cavg).astype(float, copy=False)
+
+        # Stack the densities on the basis and on each other
+        bases = None
+        if basis is not None:
+            bases = np.zeros_like(y)
+            np.cumsum(y[:-1], axis=0, out=bases[1:])
+            bases += basis
+            y += bases
+
         group = []
-        colors = c
         pos = position
         for idx, vals in enumerate(values):
             if position is None:
                 pos = idx + 1
-            if isinstance(c, np.ndarray) and c.ndim == 3:
-                colors = c[idx]
+            if uniform_color:
+                cols = np.broadcast_to(c, (x.shape[1], len(c)))
+            elif colors is not None:
+                cols = cavg[idx]
+            else:
+                cols = None
             zord = pos if zorder is None else zorder
-            group.append(cello(
-                vals, colors, position=pos, basis=basis, bw=bw[idx], cbw=cbw[idx],
-                scale=scale, side=side, horizontal=horizontal, zorder=zord, ax=ax,
-                **kwargs
-            ))
-            if basis is not None:
-                basis = basis + group[-1]['density']
+            base = None if bases is None else bases[idx]
+            mesh, lines = _draw_cello(
+                ax, x[idx], y[idx], vals, cols, pos, base, horizontal, side, zord
+            )
+            group.append({
+                'points': x[idx], 'density': y[idx], 'ax': ax, 'mesh': mesh,
+                'lines': lines
+            })
         return {'group': group, 'ax': ax}
 
     ## Processing solo cello
-    
-    # Color handling
-    # a. No color (None); handled below
-    # b. Named color (str)
-    # c. Single color (3 or 4 tuple)
-    # d. Color per value (n by 3-or-4 array)
-    if c is not None:
-        if (
-                isinstance(c, str) or
-                np.ndim(c) == 0 or
-                (isinstance(c, (tuple, list)) and len(c) in (3, 4))
-        ):
-            from matplotlib.colors import to_rgba
-            c = np.tile(to_rgba(c), (len(values), 1))
         
     # Single cello plot
     if isinstance(points, int):
@@ -205,54 +578,18 @@ def cello(values, c=None, position=None, basis=None, bw=None, cbw=None, scale=10
     else:
         x = np.asarray(points)
 
-    w = np.exp(-((x[:, None] - values[None, :])**2) / (bw**2))
-    y = scale * w.sum(axis=1) / w.sum()  # normalized density
+    method = _kde_method(points, len(values), kwargs.get('numba', False))
+    wsum, cavg = _kde(x, values, bw, cbw, colors, method, dtype)
+    y = np.asarray(wsum, dtype=float)
+    y *= scale / y.sum()  # normalized density
     if basis is not None:
         y += basis
 
-    # Modify for ribbon
-    xx = np.array([x, x])
-    yy = (np.array([y, -y]).T * (1, side not in ('right', 'left'))).T
-    if basis is not None:
-        yy[1] = basis
-        if side == 'left':
-            pass
-        elif side == 'right':
-            yy = -yy
-        else:
-            xx = np.hstack([xx, xx[:, ::-1]])
-            yy = np.hstack([yy, -yy[:, ::-1]])
-    if position is not None:
-        yy += position
-    xx, yy = [xx, yy] if horizontal else [yy, xx] 
-    
-    # Plotting
-    
-    # - Body
-    mesh = None
-    if c is not None:
-        if cbw is not None:
-            w **= (bw/cbw)**2
-        c = np.clip((w @ c) / w.sum(axis=1)[:, None], 0, 1)
-        cc = np.array([c, c])
-        if basis is not None:
-            cc = np.hstack([cc, cc[:, ::-1]])
-        mesh = ax.pcolormesh(xx, yy, cc, shading='gouraud', zorder=zorder)
-
-    # - Outlines
-    lines = []
-    lines.append(ax.plot(xx[0,:len(x)], yy[0,:len(x)], c='k', linewidth=0.5, zorder=zorder))
-    lines.append(ax.plot(xx[1,:len(x)], yy[0,:len(x)], c='k', linewidth=0.5, zorder=zorder))
-    if 1 or basis is not None and side not in ('left', 'right'):
-        lines.append(ax.plot(xx[0,len(x):], yy[0,len(x):], c='k', linewidth=0.5, zorder=zorder))
-        lines.append(ax.plot(xx[1,len(x):], yy[0,len(x):], c='k', linewidth=0.5, zorder=zorder))
-                 
-    # - Base line, always marking the domain of the data
-    #   Thicker line draws data, thinner line extent of density
-    #   TODO: control line thicknesses
-    xy = [[x.min(), x.max()], [position, position]]
-    lines.append(ax.plot(xy[not horizontal], xy[horizontal], c='k', linewidth=0.5, zorder=zorder))
-    xy = [[values.min(), values.max()], [position, position]]
-    lines.append(ax.plot(xy[not horizontal], xy[horizontal], c='k', linewidth=2, zorder=zorder))
+    if uniform_color:
+        # The weighted average of a single color is the color itself
+        c = np.broadcast_to(c, (len(x), len(c)))
+    elif c is not None:
+        c = np.clip(cavg, 0, 1, out=cavg).astype(float, copy=False)
+    mesh, lines = _draw_cello(ax, x, y, values, c, position, basis, horizontal, side, zorder)
     
-    return {'points': x, 'density': y, 'ax': ax, 'mesh': mesh}
+    return {'points': x, 'density': y, 'ax': ax, 'mesh': mesh, 'lines': lines}